@@ -26,6 +26,8 @@ PARAM_DICT['hid_state_size'] = 1500
 PARAM_DICT['masking'] = False
 PARAM_DICT['mask_value'] = 500
 PARAM_DICT['kl_weight'] = 1.0
+PARAM_DICT['log_cov'] = False  # gaussian nets output log-covariance directly instead of softplus covariance
+PARAM_DICT['use_xla'] = False  # let XLA fuse the unrolled step ops into fewer kernels
 
 # infer some necessary network sizes
 PARAM_DICT['in_dim'] = PARAM_DICT['x_dim']
@@ -48,6 +50,7 @@ phi_prior_out = 300
 phi_dec_out = 300
 
 # specify each net
+# phi_x can be {'name': 'phi_x', 'nn_type': 'identity'} with phi_x_out = in_dim, which saves one MLP per step
 PARAM_DICT['phi_x'] = {'name': 'phi_x',
                        'nn_type': 'general_mlp',
                        'activation': 'relu',
@@ -60,7 +63,8 @@ PARAM_DICT['phi_prior'] = {'name': 'phi_prior',
                            'out2dist': 'gauss',
                            'init_sig_var': 0.01,
                            'init_sig_bias': 0.0,
-                           'dist_dim':  PARAM_DICT['z_dim']
+                           'dist_dim':  PARAM_DICT['z_dim'],
+                           'log_cov': PARAM_DICT['log_cov']
                            }
 
 PARAM_DICT['phi_enc'] = {'name': 'phi_enc',
@@ -70,7 +74,8 @@ PARAM_DICT['phi_enc'] = {'name': 'phi_enc',
                          'out2dist': 'gauss',
                          'init_sig_var': 0.01,
                          'init_sig_bias': 0.0,
-                         'dist_dim':  PARAM_DICT['z_dim']
+                         'dist_dim':  PARAM_DICT['z_dim'],
+                         'log_cov': PARAM_DICT['log_cov']
                          }
 
 PARAM_DICT['phi_z'] = {'name': 'phi_z',
@@ -86,7 +91,8 @@ PARAM_DICT['phi_dec'] = {'name': 'phi_dec',
                          'init_sig_var': 0.01,
                          'init_sig_bias': 0.0,
                          'modes': PARAM_DICT['modes_out'],
-                         'dist_dim':  PARAM_DICT['x_dim']
+                         'dist_dim':  PARAM_DICT['x_dim'],
+                         'log_cov': PARAM_DICT['log_cov']
                          }
 
 PARAM_DICT['f_theta'] = {'name': 'f_theta',
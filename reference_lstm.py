@@ -59,7 +59,7 @@ def lstm_loop(x_pl, state, err_acc, count, params, fd):
     x_now = tf.squeeze(tf.slice(x_pl, [tf.to_int32(count), 0, 0], [1, -1, -1]), axis=[0])
     x_next = tf.squeeze(tf.slice(x_pl, [tf.to_int32(count + 1), 0, 0], [1, -1, -1]), axis=[0])
     dist, state = lstm_inference(x_now, state, fd)
-    err_t = tf.reduce_mean(gaussian_log_p(dist, x_next, params['x_dim'])[0])
+    err_t = tf.reduce_mean(gaussian_log_p(dist, x_next, params['x_dim'], log_cov=False)[0])
     err_acc -= err_t
     count += 1
     return x_pl, state, err_acc, count
@@ -27,6 +27,12 @@ class NetGen:
                 return general_mlp(in_pl, params)
             self.fd[name] = f
 
+        if params['nn_type'] == 'identity':  # passes inputs through, e.g. phi_x on low-dimensional data
+
+            def f(in_pl):
+                return in_pl
+            self.fd[name] = f
+
         if params['nn_type'] == 'simple_lstm':
             self.fd[name] = simple_lstm(params, name)
 
@@ -47,6 +53,10 @@ class NetGen:
         """ concatenates several tensors into one input to existing nn of given name """
         f = self.fd[name]
 
+        if isinstance(f, tf.contrib.rnn.RNNCell):
+            self.fd[name] = JointInputCell(f, name)
+            return
+
         def g(*args):
             in_pl = tf.concat(list(args), axis=1, name=name + "_joint_inputs")
             return f(in_pl)
@@ -102,6 +112,36 @@ def general_lstm(params, name):
     return multi_cell
 
 
+def cov_out(lin_out, params):
+    """ maps linear output to covariance via softplus or, if 'log_cov' is set in params, to log-covariance """
+    if 'log_cov' in params and params['log_cov']:
+        return lin_out
+    return tf.nn.softplus(lin_out)
+
+
+class JointInputCell(tf.contrib.rnn.RNNCell):
+    """ wraps an rnn cell so it takes a tuple of inputs, which are concatenated before the wrapped cell """
+    def __init__(self, cell, name):
+        super().__init__()
+        self._cell = cell
+        self._concat_name = name + '_joint_inputs'
+
+    @property
+    def state_size(self):
+        return self._cell.state_size
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def zero_state(self, batch_size, dtype):
+        return self._cell.zero_state(batch_size, dtype)
+
+    def __call__(self, inputs, state, scope=None):
+        in_pl = tf.concat(list(inputs), axis=1, name=self._concat_name)
+        return self._cell(in_pl, state, scope)
+
+
 def out_to_normal(net_fun, params):
     """ adapt a net to output parameters of a decorrelated Gaussian distribution """
     d_dist = params['dist_dim']
@@ -119,7 +159,7 @@ def out_to_normal(net_fun, params):
                                                                                       mean=0,
                                                                                       stddev=params['init_sig_var']))
             cov_biases = tf.get_variable(name + '_c_b', initializer=tf.random_normal([d_dist], mean=0))
-            cov = tf.nn.softplus(tf.matmul(net_out, cov_weights) + cov_biases)
+            cov = cov_out(tf.matmul(net_out, cov_weights) + cov_biases, params)
         return mean, cov
     return f
 
@@ -141,7 +181,7 @@ def out_to_normal_plus_binary(net_fun, params):
                                                                                       mean=0,
                                                                                       stddev=params['init_sig_var']))
             cov_biases = tf.get_variable(name + '_c_b', initializer=tf.random_normal([d_dist], mean=0))
-            cov = tf.nn.softplus(tf.matmul(net_out, cov_weights) + cov_biases)
+            cov = cov_out(tf.matmul(net_out, cov_weights) + cov_biases, params)
 
             bin_weights = tf.get_variable(name + '_bin_w', initializer=tf.random_normal([d_out, 1], mean=0, stddev=0.01))
             bin_biases = tf.get_variable(name + '_bin_b', initializer=tf.random_normal([1], mean=0))
@@ -172,7 +212,7 @@ def out_to_gm(net_fun, params):
                                           initializer=tf.random_normal([d_out, num_modes * d_dist],
                                                                        mean=params['init_sig_bias'],
                                                                        stddev=params['init_sig_var']))
-            cov = tf.reshape(tf.nn.softplus(tf.matmul(net_out, cov_weights)), [-1, num_modes, d_dist])
+            cov = tf.reshape(cov_out(tf.matmul(net_out, cov_weights), params), [-1, num_modes, d_dist])
 
         return mean, cov, pi_logit
     return f
@@ -203,7 +243,7 @@ def out_to_gm_plus_binary(net_fun, params):
                                                                        mean=params['init_sig_bias'],
                                                                        stddev=params['init_sig_var']))
             cov_biases = tf.get_variable(name + '_c_b', initializer=tf.random_normal([num_modes * d_dist], mean=0))
-            cov = tf.reshape(tf.nn.softplus(tf.matmul(net_out, cov_weights) + cov_biases), [-1, num_modes, d_dist])
+            cov = tf.reshape(cov_out(tf.matmul(net_out, cov_weights) + cov_biases, params), [-1, num_modes, d_dist])
 
             bin_weights = tf.get_variable(name + '_bin_w', initializer=tf.random_normal([d_out, 1], mean=0, stddev=0.01))
             bin_biases = tf.get_variable(name + '_bin_b', initializer=tf.random_normal([1], mean=0, stddev=0.01))
@@ -247,6 +287,8 @@ def count_params(param_dict, net_names):
     num_params = 0
     nets = [param_dict[k] for k in net_names]
     for net in nets:
+        if net['nn_type'] == 'identity':
+            continue
         l = net['layers']
         for idx in range(1, len(l)):
             num_params += (l[idx-1] + 1) * l[idx]
@@ -1,24 +1,44 @@
 import tensorflow as tf
 import numpy as np
 
+LOG_2PI = float(np.log(2 * np.pi))
 
-def sample(params, eps, dist='gauss'):
-    """ utility function for sampling from distributions, given noise """
+
+class VRNNCells:
+    """ holds the networks of a VRNN as attributes, so they are resolved once rather than looked up every step """
+    def __init__(self, fd):
+        self.phi_x = fd['phi_x']
+        self.phi_prior = fd['phi_prior']
+        self.phi_enc = fd['phi_enc'] if 'phi_enc' in fd else None  # not built for generation
+        self.phi_z = fd['phi_z']
+        self.phi_dec = fd['phi_dec']
+        self.f_theta = fd['f_theta']
+
+
+def sample(params, eps, dist='gauss', log_cov=False):
+    """
+    utility function for sampling from distributions, given noise. covariances may be given in log-space.
+    for mixtures, eps holds gaussian noise and gumbel noise over the modes, which picks the component (gumbel-max)
+    """
     if 'bin' in dist:
         logits = params[-1]
         params = params[:-1]
     if 'gauss' in dist:
         mean, cov = params
-        s = mean + tf.sqrt(cov) * eps
+        if log_cov:
+            s = mean + tf.exp(0.5 * cov) * eps
+        else:
+            s = mean + tf.sqrt(cov) * eps
     elif 'gm' in dist:
         means, covs, pi_logits = params
-        choices = tf.multinomial(pi_logits, num_samples=1)
-        batch_size = choices.get_shape()[0]
-        ids = tf.constant(list(range(batch_size)), dtype=tf.int64, shape=(batch_size, 1))
-        idx_tensor = tf.concat([ids, choices], axis=1)
-        chosen_means = tf.gather_nd(means, idx_tensor)
-        chosen_covs = tf.gather_nd(covs, idx_tensor)
-        s = chosen_means + tf.sqrt(chosen_covs) * eps
+        eps, eps_pi = eps
+        choices = tf.argmax(pi_logits + eps_pi, axis=1)
+        chosen_means = tf.gather(means, choices, batch_dims=1)
+        chosen_covs = tf.gather(covs, choices, batch_dims=1)
+        if log_cov:
+            s = chosen_means + tf.exp(0.5 * chosen_covs) * eps
+        else:
+            s = chosen_means + tf.sqrt(chosen_covs) * eps
     else:
         raise NotImplementedError
 
@@ -28,65 +48,83 @@ def sample(params, eps, dist='gauss'):
     return s
 
 
-def inference(in_pl, hid_pl, f_state, eps_z, fd):
+def inference(in_pl, hid_pl, f_state, eps_z, pd, cells):
     """ builds inference model for one time step """
-    phi_x = fd['phi_x'](in_pl)
-    mean_0, cov_0 = fd['phi_prior'](hid_pl)
-    mean_z, cov_z = fd['phi_enc'](phi_x, hid_pl)
-    z = sample((mean_z, cov_z), eps_z, 'gauss')
-    phi_z = fd['phi_z'](z)
-    params_out = fd['phi_dec'](phi_z, hid_pl)
-    f_in = tf.concat([phi_x, phi_z], axis=1, name='f_theta_joint_inputs')
-    f_out, f_state = fd['f_theta'](f_in, f_state)
+    phi_x = cells.phi_x(in_pl)
+    mean_0, cov_0 = cells.phi_prior(hid_pl)
+    mean_z, cov_z = cells.phi_enc(phi_x, hid_pl)
+    z = sample((mean_z, cov_z), eps_z, 'gauss', log_cov=pd['log_cov'])
+    phi_z = cells.phi_z(z)
+    params_out = cells.phi_dec(phi_z, hid_pl)
+    f_out, f_state = cells.f_theta((phi_x, phi_z), f_state)
     return mean_0, cov_0, mean_z, cov_z, params_out, f_out, f_state
 
 
-def gaussian_log_p(params_out, x_target, dim):
-    """ computes log probability of target in Gaussian with given parameters """
+def gaussian_log_p(params_out, x_target, dim, log_cov=False):
+    """
+    computes log probability of target in Gaussian with given mean and covariance (or log-covariance),
+    plus mean abs error
+    """
     mean_x, cov_x = params_out
     x_diff = x_target - mean_x
-    x_square = tf.reduce_sum((x_diff / cov_x) * x_diff, axis=[1])
+    if log_cov:
+        inv_cov_x = tf.exp(-cov_x)
+        log_cov_x_det = tf.reduce_sum(cov_x, axis=[1])
+    else:
+        inv_cov_x = tf.reciprocal(cov_x)
+        log_cov_x_det = tf.reduce_sum(tf.log(cov_x), axis=[1])
+    x_square = tf.reduce_sum(x_diff * x_diff * inv_cov_x, axis=[1])
     log_x_exp = -0.5 * x_square
-    log_cov_x_det = tf.reduce_sum(tf.log(cov_x), axis=[1])
-    log_x_norm = -0.5 * (dim * tf.log(2 * np.pi) + log_cov_x_det)
+    log_x_norm = -0.5 * (dim * LOG_2PI + log_cov_x_det)
     log_p = log_x_norm + log_x_exp
-    return log_p, log_x_norm, log_x_exp, tf.abs(x_diff)
+    return log_p, log_x_norm, log_x_exp, tf.reduce_mean(tf.abs(x_diff))
 
 
-def gm_log_p(params_out, x_target, dim):
-    """ computes log probability of target in Gaussian mixture with given parameters """
+def gm_log_p(params_out, x_target, dim, log_cov=False):
+    """
+    computes log probability of target in Gaussian mixture with given means, covariances (or log-covariances)
+    and logits, plus mean abs error over all components
+    """
     mean_x, cov_x, pi_x_logit = params_out
-    pi_x = tf.nn.softmax(pi_x_logit)
-    mean_x = tf.transpose(mean_x, perm=[1, 0, 2])
-    cov_x = tf.transpose(cov_x, perm=[1, 0, 2])
-    pi_x = tf.transpose(pi_x, perm=[1, 0])
+    log_pi_x = tf.nn.log_softmax(pi_x_logit)
 
-    x_diff = x_target - mean_x
-    x_square = tf.reduce_sum((x_diff / cov_x) * x_diff, axis=[2])
+    x_diff = tf.expand_dims(x_target, 1) - mean_x
+    if log_cov:
+        inv_cov_x = tf.exp(-cov_x)
+        log_cov_x_det = tf.reduce_sum(cov_x, axis=[2])
+    else:
+        inv_cov_x = tf.reciprocal(cov_x)
+        log_cov_x_det = tf.reduce_sum(tf.log(cov_x), axis=[2])
+    x_square = tf.reduce_sum(x_diff * x_diff * inv_cov_x, axis=[2])
     log_x_exp = -0.5 * x_square
-    log_cov_x_det = tf.reduce_sum(tf.log(cov_x), axis=[2])
-    log_x_norm = -0.5 * (dim * tf.log(2 * np.pi) + log_cov_x_det) + pi_x
-    log_p = tf.reduce_logsumexp(log_x_norm + log_x_exp, axis=[0])
-    return log_p, log_x_norm, log_x_exp, tf.abs(x_diff)
+    log_x_norm = -0.5 * (dim * LOG_2PI + log_cov_x_det) + log_pi_x
 
+    log_comp = log_x_norm + log_x_exp
+    log_comp_max = tf.stop_gradient(tf.reduce_max(log_comp, axis=[1], keepdims=True))
+    log_comp_max = tf.where(tf.is_finite(log_comp_max), log_comp_max, tf.zeros_like(log_comp_max))
+    log_p = tf.squeeze(log_comp_max, axis=[1]) + tf.log(tf.reduce_sum(tf.exp(log_comp - log_comp_max), axis=[1]))
+    return log_p, log_x_norm, log_x_exp, tf.reduce_mean(tf.abs(x_diff))
 
-def gaussian_kl_div(mean_0, cov_0, mean_1, cov_1, dim):
-    """ computes KL divergences between two Gaussians with given parameters"""
+
+def gaussian_kl_div(mean_0, cov_0, mean_1, cov_1, log_cov=False):
+    """
+    computes KL divergences between two Gaussians with given means and covariances (or log-covariances)
+    in a single reduction
+    """
     mean_diff = mean_1 - mean_0
-    cov_1_inv = tf.reciprocal(cov_1)
-    log_cov_1_det = tf.reduce_sum(tf.log(cov_1), axis=[1])
-    log_cov_0_det = tf.reduce_sum(tf.log(cov_0), axis=[1])
-    log_term = log_cov_1_det - log_cov_0_det
-    trace_term = tf.reduce_sum(cov_1_inv * cov_0, axis=[1])
-    square_term = tf.reduce_sum(mean_diff * cov_1_inv * mean_diff, axis=[1])
-    kl_div = 0.5 * (trace_term + square_term - dim + log_term)
+    if log_cov:
+        log_ratio = cov_1 - cov_0
+        kl_terms = log_ratio + tf.exp(-log_ratio) + mean_diff * mean_diff * tf.exp(-cov_1) - 1.0
+    else:
+        kl_terms = tf.log(cov_1 / cov_0) + (cov_0 + mean_diff * mean_diff) * tf.reciprocal(cov_1) - 1.0
+    kl_div = 0.5 * tf.reduce_sum(kl_terms, axis=[1])
     return kl_div
 
 
 def ce_loss(logits_out, bin_target):
     """ computes binary cross entropy loss given logit estimate and target"""
     l = tf.nn.sigmoid_cross_entropy_with_logits(logits=logits_out, labels=bin_target, name='ce_loss')
-    return tf.squeeze(l)
+    return tf.reduce_sum(l, axis=[1])
 
 
 def loss(x_target, mean_0, cov_0, mean_z, cov_z, params_out, param_dict):
@@ -95,35 +133,35 @@ def loss(x_target, mean_0, cov_0, mean_z, cov_z, params_out, param_dict):
     employs masking, if enabled. also returns partial losses in most setups (inaccurate with masking)
     """
     maybe_ce = []
+    log_cov = param_dict['log_cov']
 
-    kl_div = gaussian_kl_div(mean_z, cov_z, mean_0, cov_0, param_dict['z_dim'])
+    kl_div = gaussian_kl_div(mean_z, cov_z, mean_0, cov_0, log_cov)
     if param_dict['model'] == 'gauss_out':
-        log_p, log_x_norm, log_x_exp, abs_diff = gaussian_log_p(params_out, x_target, param_dict['x_dim'])
+        log_p, log_x_norm, log_x_exp, diff = gaussian_log_p(params_out, x_target, param_dict['x_dim'], log_cov)
     elif param_dict['model'] == 'gm_out':
-        log_p, log_x_norm, log_x_exp, abs_diff = gm_log_p(params_out, x_target, param_dict['x_dim'])
+        log_p, log_x_norm, log_x_exp, diff = gm_log_p(params_out, x_target, param_dict['x_dim'], log_cov)
     elif param_dict['model'] == 'gauss_out_bin':
         dist_target = tf.slice(x_target, [0, 0], [-1, param_dict['x_dim']])
         bin_target = tf.slice(x_target, [0, param_dict['x_dim']], [-1, 1])
-        log_p, log_x_norm, log_x_exp, abs_diff = gaussian_log_p(params_out[:-1], dist_target, param_dict['x_dim'])
+        log_p, log_x_norm, log_x_exp, diff = gaussian_log_p(params_out[:-1], dist_target, param_dict['x_dim'], log_cov)
         maybe_ce = [ce_loss(params_out[-1], bin_target)]
     elif param_dict['model'] == 'gm_out_bin':
         dist_target = tf.slice(x_target, [0, 0], [-1, param_dict['x_dim']])
         bin_target = tf.slice(x_target, [0, param_dict['x_dim']], [-1, 1])
-        log_p, log_x_norm, log_x_exp, abs_diff = gm_log_p(params_out[:-1], dist_target, param_dict['x_dim'])
+        log_p, log_x_norm, log_x_exp, diff = gm_log_p(params_out[:-1], dist_target, param_dict['x_dim'], log_cov)
         maybe_ce = [ce_loss(params_out[-1], bin_target)]
     else:
         raise NotImplementedError
 
     if param_dict['masking']:
-        zero_vals = tf.abs(x_target - tf.constant(param_dict['mask_value'], dtype=tf.float32))
-        mask = tf.sign(tf.reduce_max(zero_vals, axis=1))
+        mask = tf.cast(tf.reduce_any(tf.not_equal(x_target, param_dict['mask_value']), axis=1), x_target.dtype)
         num_live_samples = tf.reduce_sum(mask, axis=0)
-        log_p = tf.reduce_sum(tf.where(tf.equal(mask, 0.0), mask, log_p), name='log_p_sum') / num_live_samples
-        kl_div = tf.reduce_sum(tf.where(tf.equal(mask, 0.0), mask, kl_div), name='kl_div_sum') / num_live_samples
+        inv_live = tf.reciprocal(tf.maximum(num_live_samples, 1.0))  # guards against fully masked batches
+        log_p = tf.reduce_sum(mask * log_p, name='log_p_sum') * inv_live
+        kl_div = tf.reduce_sum(mask * kl_div, name='kl_div_sum') * inv_live
         bound = (param_dict['kl_weight'] * kl_div) - log_p
         if 'bin' in param_dict['model']:
-            maybe_ce[0] = tf.where(tf.equal(mask, 0.0), mask, maybe_ce[0])
-            maybe_ce[0] = tf.reduce_sum(maybe_ce[0]) / num_live_samples
+            maybe_ce[0] = tf.reduce_sum(mask * maybe_ce[0]) * inv_live
             bound += maybe_ce[0]
         # norm = tf.reduce_sum(tf.where(tf.equal(mask, 0.0), mask, log_x_norm)) / num_live_samples
         # exp = tf.reduce_sum(tf.where(tf.equal(mask, 0.0), mask, log_x_exp)) / num_live_samples
@@ -135,11 +173,11 @@ def loss(x_target, mean_0, cov_0, mean_z, cov_z, params_out, param_dict):
         log_p = tf.reduce_mean(log_p)
         bound = (param_dict['kl_weight'] * kl_div) - log_p
         if 'bin' in param_dict['model']:
-            bound += tf.reduce_mean(maybe_ce[0])
+            maybe_ce[0] = tf.reduce_mean(maybe_ce[0])
+            bound += maybe_ce[0]
 
     norm = tf.reduce_mean(log_x_norm)
     exp = tf.reduce_mean(log_x_exp)
-    diff = tf.reduce_mean(abs_diff)
     sub_losses = [kl_div, log_p, norm, exp, diff] + maybe_ce
 
     return bound, sub_losses
@@ -147,43 +185,64 @@ def loss(x_target, mean_0, cov_0, mean_z, cov_z, params_out, param_dict):
 
 def optimization(err_acc, learning_rate):
     """
-    creates train operation using ADAM and gradient clipping
+    creates train operation using ADAM and global norm gradient clipping
     """
     optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate)
     tvars = tf.trainable_variables()
     grads = tf.gradients(err_acc, tvars)
-    tg_pairs = [(tf.clip_by_value(k[0], -100, 100), k[1]) for k in zip(grads, tvars) if k[0] is not None]
-    train_op = optimizer.apply_gradients(tg_pairs)
+    grads, tvars = zip(*[k for k in zip(grads, tvars) if k[0] is not None])
+    grads, _ = tf.clip_by_global_norm(grads, clip_norm=100.0)
+    train_op = optimizer.apply_gradients(zip(grads, tvars))
     return train_op
 
 
-def train_loop(x_pl, f_theta, bound_acc, count, f_state, eps_z, param_dict, fun_dict, tracked_tensors):
+def train_step(acc, inputs, param_dict, cells):
     """
-    executes one timestep of inference and accumulates loss (and partial losses) passes results for next timestep
+    executes one timestep of inference on the scanned inputs and returns loss (and partial losses) of that step
+    alongside the state for the next timestep
     """
-    x_t = tf.squeeze(tf.slice(x_pl, [tf.to_int32(count), 0, 0], [1, -1, -1]), axis=[0])
-    eps_z_t = tf.squeeze(tf.slice(eps_z, [tf.to_int32(count), 0, 0], [1, -1, -1]), axis=[0])
+    f_theta, f_state = acc[:2]
+    x_t, eps_z_t = inputs
 
-    mean_0, cov_0, mean_z, cov_z, params_out, f_theta, f_state = inference(x_t, f_theta, f_state, eps_z_t, fun_dict)
+    mean_0, cov_0, mean_z, cov_z, params_out, f_theta, f_state = inference(x_t, f_theta, f_state, eps_z_t,
+                                                                           param_dict, cells)
     bound_step, sub_losses_step = loss(x_t, mean_0, cov_0, mean_z, cov_z, params_out, param_dict)
 
-    bound_acc += bound_step
-    sub_losses_acc = tracked_tensors[0]
-    sub_losses_acc = [a + s for (a, s) in zip(sub_losses_acc, sub_losses_step)]
-
     mean_x, cov_x = params_out[:2]
     dist_params = [mean_0, cov_0, mean_z, cov_z, mean_x, cov_x]
 
-    tracked_tensors = [sub_losses_acc, dist_params]
-    count += 1
-    return x_pl, f_theta, bound_acc, count, f_state, eps_z, tracked_tensors
+    tracked_tensors = [sub_losses_step, dist_params]
+    return f_theta, f_state, bound_step, tracked_tensors
 
 
-def get_train_loop_fun(param_dict, fun_dict):
-    """ function wrapper to assign the dicts. return value can be looped with tf.while_loop """
-    def train_loop_fun(x_pl, hid_pl, err_acc, count, f_state, eps_z, debug_tensors):
-        return train_loop(x_pl, hid_pl, err_acc, count, f_state, eps_z, param_dict, fun_dict, debug_tensors)
-    return train_loop_fun
+def get_train_step_fun(param_dict, fun_dict):
+    """ function wrapper to assign the dicts. return value can be scanned over time with tf.scan """
+    cells = VRNNCells(fun_dict)
+
+    def train_step_fun(acc, inputs):
+        return train_step(acc, inputs, param_dict, cells)
+    return train_step_fun
+
+
+def train_scan(x_pl, hid_pl, f_state, eps_z, tracked_tensors, param_dict, fun_dict):
+    """
+    runs inference over the whole sequence in a single tf.scan over the time axis of x_pl and eps_z.
+    returns summed bound, summed partial losses, distribution parameters of the last timestep and final f_state
+    """
+    step_fun = get_train_step_fun(param_dict, fun_dict)
+    init = (hid_pl, f_state, tf.constant(0, dtype=tf.float32, name='bound_init'), tracked_tensors)
+
+    _ = step_fun(init, (x_pl[0], eps_z[0]))  # quick fix - need to init variables outside the loop
+
+    with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        scan_res = tf.scan(step_fun, (x_pl, eps_z), initializer=init)
+
+    _, f_states, bound_steps, (sub_losses_steps, dist_params_steps) = scan_res
+    bound_final = tf.reduce_sum(bound_steps, axis=0)
+    sub_losses = [tf.reduce_sum(s, axis=0) for s in sub_losses_steps]
+    dist_params = [d[-1] for d in dist_params_steps]
+    f_final = tf.nest.map_structure(lambda t: t[-1], f_states)
+    return bound_final, sub_losses, dist_params, f_final
 
 
 def get_train_stop_fun(num_iter):
@@ -194,34 +253,34 @@ def get_train_stop_fun(num_iter):
     return train_stop_fun
 
 
-def generation(hid_pl, f_state, eps_z, eps_x, pd, fd):
+def generation(hid_pl, f_state, eps_z, eps_x, pd, cells):
     """ builds generative model for one time step """
-    params_prior = fd['phi_prior'](hid_pl)
-    z = sample(params_prior, eps_z, 'gauss')
-    phi_z = fd['phi_z'](z)
-    params_out = fd['phi_dec'](phi_z, hid_pl)
-    x = sample(params_out, eps_x, pd['model'])
-
-    phi_x = fd['phi_x'](x)
-    f_in = tf.concat([phi_x, phi_z], axis=1, name='f_theta_joint_inputs')
-    f_out, f_state = fd['f_theta'](f_in, f_state)
+    params_prior = cells.phi_prior(hid_pl)
+    z = sample(params_prior, eps_z, 'gauss', log_cov=pd['log_cov'])
+    phi_z = cells.phi_z(z)
+    params_out = cells.phi_dec(phi_z, hid_pl)
+    x = sample(params_out, eps_x, pd['model'], log_cov=pd['log_cov'])
+
+    phi_x = cells.phi_x(x)
+    f_out, f_state = cells.f_theta((phi_x, phi_z), f_state)
     return x, f_out, f_state
 
 
-def gen_loop(x_pl, hid_pl, count, f_state, eps_z, eps_x, pd, fun_dict):
+def gen_loop(x_pl, hid_pl, count, f_state, eps_z, eps_x, pd, cells):
     """
-    executes one timestep of generation and accumulates results, writing to x_pl. passes results for next timestep
+    executes one timestep of generation and accumulates results, writing to the TensorArray x_pl.
+    passes results for next timestep
     """
-    eps_z_t = tf.squeeze(tf.slice(eps_z, [tf.to_int32(count), 0, 0], [1, -1, -1]), axis=[0])
-    eps_x_t = tf.squeeze(tf.slice(eps_x, [tf.to_int32(count), 0, 0], [1, -1, -1]), axis=[0])
+    t = tf.to_int32(count)
+    eps_z_t = eps_z[t]
+    if 'gm' in pd['model']:  # eps_x holds gaussian and gumbel noise
+        eps_x_t = [e[t] for e in eps_x]
+    else:
+        eps_x_t = eps_x[t]
 
-    x_t, f_out, f_state = generation(hid_pl, f_state, eps_z_t, eps_x_t, pd, fun_dict)
+    x_t, f_out, f_state = generation(hid_pl, f_state, eps_z_t, eps_x_t, pd, cells)
 
-    x_old = tf.slice(x_pl, [0, 0, 0], [tf.to_int32(count), -1, -1])
-    x_empty = tf.slice(x_pl, [tf.to_int32(count) + 1, 0, 0], [-1, -1, -1])
-    x_t = tf.reshape(x_t, [1, pd['batch_size'], pd['in_dim']])
-    x_pl = tf.concat([x_old, x_t, x_empty], axis=0)
-    x_pl.set_shape([pd['seq_length'], pd['batch_size'], pd['in_dim']])
+    x_pl = x_pl.write(t, x_t)
 
     count += 1
     return x_pl, f_out, count, f_state, eps_z, eps_x
@@ -229,8 +288,10 @@ def gen_loop(x_pl, hid_pl, count, f_state, eps_z, eps_x, pd, fun_dict):
 
 def get_gen_loop_fun(param_dict, fun_dict):
     """ function wrapper to assign the dicts. return value can be looped with tf.while_loop """
+    cells = VRNNCells(fun_dict)
+
     def f(x_pl, hid_pl, count, f_state, eps_z, eps_x):
-        return gen_loop(x_pl, hid_pl, count, f_state, eps_z, eps_x, param_dict, fun_dict)
+        return gen_loop(x_pl, hid_pl, count, f_state, eps_z, eps_x, param_dict, cells)
     return f
 
 
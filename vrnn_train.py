@@ -51,8 +51,8 @@ def get_train_batch_dict_generator(data, in_pl, hid_pl, eps_z, pd):
 
 def get_tracking_placeholders(pd):
     """ 
-    creates placeholders for tracked partial losses and distribution parameters so the can be added to summaries
-    outside of the while loop (parts of this have been removed below to speed up training)
+    creates initial values for tracked partial losses and distribution parameters so the can be added to summaries
+    outside of the scan (parts of this have been removed below to speed up training)
     """
     sub_losses = [tf.constant(0, dtype=tf.float32, name='kldiv_acc'),
                   tf.constant(0, dtype=tf.float32, name='log_p_acc'),
@@ -78,6 +78,14 @@ def get_tracking_placeholders(pd):
     return [sub_losses, dist_params]
 
 
+def get_session_config(pd):
+    """ session config which enables XLA auto-clustering of the graph if pd['use_xla'] is set """
+    config = tf.ConfigProto()
+    if 'use_xla' in pd.keys() and pd['use_xla']:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
 def run_training(pd):
     """
     creates model, initializes/loads weights, runs training, storing checkpoints and summaries. 
@@ -94,32 +102,21 @@ def run_training(pd):
     for net in nets:
         netgen.add_net(pd[net])
 
-    multi_input_nets = ['phi_enc', 'phi_dec']
+    multi_input_nets = ['phi_enc', 'phi_dec', 'f_theta']
     for net in multi_input_nets:
         netgen.weave_inputs(net)
 
     with tf.Graph().as_default():
-        stop_fun = model.get_train_stop_fun(pd['seq_length'])
-        loop_fun = model.get_train_loop_fun(pd, netgen.fd)
-
         in_pl = tf.placeholder(tf.float32, name='x_pl',
                                shape=(pd['seq_length'], pd['batch_size'], pd['in_dim']))
         eps_z = tf.placeholder(tf.float32, name='eps_z',
                                shape=(pd['seq_length'], pd['batch_size'], pd['z_dim']))
         hid_pl = tf.placeholder(tf.float32, shape=(pd['batch_size'], pd['hid_state_size']), name='ht_init')
-        err_acc = tf.constant(0, dtype=tf.float32, name='diff_acc')
-        count = tf.constant(0, dtype=tf.float32, name='counter')
         f_state = netgen.fd['f_theta'].zero_state(pd['batch_size'], tf.float32)
         tracked_tensors = get_tracking_placeholders(pd)
-        loop_vars = [in_pl, hid_pl, err_acc, count, f_state, eps_z, tracked_tensors]
-
-        _ = loop_fun(*loop_vars)  # quick fix - need to init variables outside the loop
 
-        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
-            loop_res = tf.while_loop(stop_fun, loop_fun, loop_vars)
-
-        bound_final = loop_res[2]
-        sub_losses, dist_params = loop_res[-1]
+        bound_final, sub_losses, dist_params, _ = model.train_scan(in_pl, hid_pl, f_state, eps_z, tracked_tensors,
+                                                                   pd, netgen.fd)
 
         train_op = model.optimization(bound_final, pd['learning_rate'])
 
@@ -140,6 +137,8 @@ def run_training(pd):
         dist_names = ['mean_0', 'cov_0', 'mean_z', 'cov_z', 'mean_x', 'cov_x']
         cuts = [40, 5, 40, 5, 10, 5]
         for t, name, cut in zip(dist_params, dist_names, cuts):
+            if pd['log_cov'] and 'cov' in name:  # nets output log-covariances, summarise covariances
+                t = tf.exp(t)
             tf.summary.histogram('debug/raw/' + name, t)
             t = tf.maximum(t, -cut)
             t = tf.minimum(t, cut)
@@ -149,7 +148,7 @@ def run_training(pd):
 
         valid_bound = tf.summary.scalar('validation_bound', bound_final)
 
-        with tf.Session() as sess:
+        with tf.Session(config=get_session_config(pd)) as sess:
             summary_writer = tf.summary.FileWriter(pd['log_path'] + '/summaries', sess.graph)
             start_time = time.time()
 
@@ -195,13 +194,35 @@ def run_training(pd):
                     saver.save(sess, checkpoint_file, global_step=(it + 1))
 
 
+def get_gen_noise_placeholders(pd):
+    """
+    creates noise placeholders for generation. for mixture models eps_x also holds gumbel noise over the modes,
+    so component choices are drawn once per batch rather than by a sampling op in every timestep
+    """
+    eps_z = tf.placeholder(tf.float32, shape=(pd['seq_length'], pd['batch_size'], pd['z_dim']), name='eps_z')
+    eps_x = tf.placeholder(tf.float32, shape=(pd['seq_length'], pd['batch_size'], pd['x_dim']), name='eps_x')
+    if 'gm' in pd['model']:
+        eps_pi = tf.placeholder(tf.float32, shape=(pd['seq_length'], pd['batch_size'], pd['modes_out']),
+                                name='eps_pi')
+        eps_x = [eps_x, eps_pi]
+    return eps_z, eps_x
+
+
+def get_gen_noise_feed(eps_z, eps_x, pd):
+    """ fills noise placeholders created by get_gen_noise_placeholders """
+    d = {eps_z: np.random.normal(size=(pd['seq_length'], pd['batch_size'], pd['z_dim']))}
+    if 'gm' in pd['model']:
+        eps_x, eps_pi = eps_x
+        d[eps_pi] = np.random.gumbel(size=(pd['seq_length'], pd['batch_size'], pd['modes_out']))
+    d[eps_x] = np.random.normal(size=(pd['seq_length'], pd['batch_size'], pd['x_dim']))
+    return d
+
+
 def get_gen_batch_dict_generator(hid_pl, eps_z, eps_x, pd):
     """ generator fills placeholders with noise/zeros for generation """
-    d = {}
     while True:
+        d = get_gen_noise_feed(eps_z, eps_x, pd)
         d[hid_pl] = np.zeros((pd['batch_size'], pd['hid_state_size']))
-        d[eps_z] = np.random.normal(size=(pd['seq_length'], pd['batch_size'], pd['z_dim']))
-        d[eps_x] = np.random.normal(size=(pd['seq_length'], pd['batch_size'], pd['x_dim']))
         yield d
 
 
@@ -217,27 +238,23 @@ def run_generation(params_file, ckpt_file=None, batch=None):
     if batch is not None:  # needs testing
         pd['batch_size'] = batch
 
+    if 'log_cov' not in pd.keys():  # for backwards compatibility
+        pd['log_cov'] = False
+
     netgen = NetGen()
     nets = ['phi_x', 'phi_prior', 'phi_z', 'phi_dec', 'f_theta']  # phi_enc is not used
     for net in nets:
         netgen.add_net(pd[net])
 
     netgen.weave_inputs('phi_dec')
+    netgen.weave_inputs('f_theta')
 
     with tf.Graph().as_default():
         stop_fun = model.get_gen_stop_fun(pd['seq_length'])
         loop_fun = model.get_gen_loop_fun(pd, netgen.fd)
 
-        in_pl = tf.zeros([pd['seq_length'], pd['batch_size'], pd['in_dim']], dtype=tf.float32)
-        eps_z = tf.placeholder(tf.float32, shape=(pd['seq_length'], pd['batch_size'], pd['z_dim']),
-                               name='eps_z')
-        eps_x = tf.placeholder(tf.float32, shape=(pd['seq_length'], pd['batch_size'], pd['x_dim']),
-                               name='eps_x')
-        # if pd['model'] == 'gm_out':
-        #     eps_pi = tf.placeholder(tf.int32, shape=(pd['seq_length'], pd['batch_size']))
-        #     eps_out = [eps_x, eps_pi]
-        # else:
-        #     eps_out = eps_x
+        in_pl = tf.TensorArray(tf.float32, size=pd['seq_length'], element_shape=[pd['batch_size'], pd['in_dim']])
+        eps_z, eps_x = get_gen_noise_placeholders(pd)
         hid_pl = tf.placeholder(tf.float32, shape=(pd['batch_size'], pd['hid_state_size']), name='ht_init')
         count = tf.constant(0, dtype=tf.float32, name='counter')
         f_state = netgen.fd['f_theta'].zero_state(pd['batch_size'], tf.float32)
@@ -248,11 +265,11 @@ def run_generation(params_file, ckpt_file=None, batch=None):
 
         with tf.variable_scope(tf.get_variable_scope(), reuse=True):
             loop_res = tf.while_loop(stop_fun, loop_fun, loop_vars)
-        x_final = loop_res[0]
+        x_final = loop_res[0].stack()
 
         batch_dict = get_gen_batch_dict_generator(hid_pl, eps_z, eps_x, pd)
 
-        with tf.Session() as sess:
+        with tf.Session(config=get_session_config(pd)) as sess:
             saver = tf.train.Saver()
             saver.restore(sess, ckpt_file)
 
@@ -274,6 +291,8 @@ def run_read_then_continue(params_file, read_seq, ckpt_file=None, batch_size=1):
 
     if 'kl_weight' not in pd.keys():  # for backwards compatibility
         pd['kl_weight'] = 1.0
+    if 'log_cov' not in pd.keys():
+        pd['log_cov'] = False
 
     if ckpt_file is None:
         ckpt_file = pd['log_path'] + '/ckpt-' + str(pd['max_iter'])
@@ -285,37 +304,26 @@ def run_read_then_continue(params_file, read_seq, ckpt_file=None, batch_size=1):
     nets = ['phi_x', 'phi_prior', 'phi_enc', 'phi_z', 'phi_dec', 'f_theta']
     for net in nets:
         netgen.add_net(pd[net])
-    multi_input_nets = ['phi_enc', 'phi_dec']
+    multi_input_nets = ['phi_enc', 'phi_dec', 'f_theta']
     for net in multi_input_nets:
         netgen.weave_inputs(net)
 
     with tf.Graph().as_default():
-        stop_fun = model.get_train_stop_fun(pd['seq_length'])
-        loop_fun = model.get_train_loop_fun(pd, netgen.fd)
-
         in_pl = tf.placeholder(tf.float32, name='x_pl',
                                shape=(pd['seq_length'], pd['batch_size'], pd['in_dim']))
         eps_z = tf.placeholder(tf.float32, name='eps_z',
                                shape=(pd['seq_length'], pd['batch_size'], pd['z_dim']))
         hid_pl = tf.placeholder(tf.float32, shape=(pd['batch_size'], pd['hid_state_size']), name='ht_init')
-        err_acc = tf.constant(0, dtype=tf.float32, name='err_acc')
-        count = tf.constant(0, dtype=tf.float32, name='counter')
         f_state = netgen.fd['f_theta'].zero_state(pd['batch_size'], tf.float32)
         tracked_tensors = get_tracking_placeholders(pd)
-        loop_vars = [in_pl, hid_pl, err_acc, count, f_state, eps_z, tracked_tensors]
-
-        loop_fun(*loop_vars)
-        tf.get_variable_scope().reuse_variables()
-        loop_res = tf.while_loop(stop_fun, loop_fun, loop_vars)
 
-        # h_final = loop_res[1]
-        f_final = loop_res[4]
+        _, _, _, f_final = model.train_scan(in_pl, hid_pl, f_state, eps_z, tracked_tensors, pd, netgen.fd)
 
         feed = {in_pl: read_seq,
                 hid_pl: np.zeros((pd['batch_size'], pd['hid_state_size'])),
                 eps_z: np.random.normal(size=(pd['seq_length'], pd['batch_size'], pd['z_dim']))}
 
-        with tf.Session() as sess:
+        with tf.Session(config=get_session_config(pd)) as sess:
             saver = tf.train.Saver()
             saver.restore(sess, ckpt_file)
             argin = list(f_final)
@@ -328,11 +336,8 @@ def run_read_then_continue(params_file, read_seq, ckpt_file=None, batch_size=1):
         stop_fun = model.get_gen_stop_fun(pd['seq_length'])
         loop_fun = model.get_gen_loop_fun(pd, netgen.fd)
 
-        x_pl = tf.zeros([pd['seq_length'], pd['batch_size'], pd['x_dim']], dtype=tf.float32)
-        eps_z = tf.placeholder(tf.float32, shape=(pd['seq_length'], pd['batch_size'], pd['z_dim']),
-                               name='eps_z')
-        eps_x = tf.placeholder(tf.float32, shape=(pd['seq_length'], pd['batch_size'], pd['x_dim']),
-                               name='eps_x')
+        x_pl = tf.TensorArray(tf.float32, size=pd['seq_length'], element_shape=[pd['batch_size'], pd['in_dim']])
+        eps_z, eps_x = get_gen_noise_placeholders(pd)
         count = tf.constant(0, dtype=tf.float32, name='counter')
         h_state = tf.constant(h, name='ht_init')
         f_state = tuple([tf.contrib.rnn.LSTMStateTuple(tf.constant(k[0]), tf.constant(k[1])) for k in res])
@@ -343,12 +348,11 @@ def run_read_then_continue(params_file, read_seq, ckpt_file=None, batch_size=1):
         with tf.variable_scope(tf.get_variable_scope(), reuse=True):
             loop_res = tf.while_loop(stop_fun, loop_fun, loop_vars)
 
-        x_final = loop_res[0]
+        x_final = loop_res[0].stack()
 
-        feed = {eps_z: np.random.normal(size=(pd['seq_length'], pd['batch_size'], pd['z_dim'])),
-                eps_x: np.random.normal(size=(pd['seq_length'], pd['batch_size'], pd['x_dim']))}
+        feed = get_gen_noise_feed(eps_z, eps_x, pd)
 
-        with tf.Session() as sess:
+        with tf.Session(config=get_session_config(pd)) as sess:
             saver = tf.train.Saver()
             saver.restore(sess, ckpt_file)
 